@@ -1,24 +1,143 @@
 # app.py
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request
 import os
+import multiprocessing
+import cv2
+import numpy as np
+import orjson
+import ahocorasick
+import queue
+import re
+import shutil
 import threading
-import json
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 from utils import *
 
 app = Flask(__name__)
 
+def json_response(obj):
+    """Serialize a JSON response with orjson"""
+    return Response(orjson.dumps(obj), mimetype='application/json')
+
 # Define folders
 UPLOAD_FOLDER = 'uploads'
 RESULTS_FOLDER = 'results'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(RESULTS_FOLDER, exist_ok=True)
 
+class StatusStore:
+    """Thread-safe status map with striped locks; finished entries expire after ttl seconds"""
+
+    def __init__(self, ttl=3600, stripes=16):
+        self._ttl = ttl
+        self._mask = stripes - 1
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        self._buckets = [{} for _ in range(stripes)]  # key -> (status, expires_at)
+
+    def _stripe(self, key):
+        return hash(key) & self._mask
+
+    def _expiry(self, status):
+        # Jobs still running never expire
+        if status.get("status") == "in_progress":
+            return None
+        return time.monotonic() + self._ttl
+
+    def get(self, key, default=None):
+        i = self._stripe(key)
+        entry = self._buckets[i].get(key)
+        if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+            return entry[0]
+        if entry is not None:
+            with self._locks[i]:
+                current = self._buckets[i].get(key)
+                if current is not None and current[1] is not None and current[1] <= time.monotonic():
+                    del self._buckets[i][key]
+        return default
+
+    def setdefault(self, key, status):
+        i = self._stripe(key)
+        with self._locks[i]:
+            entry = self._buckets[i].get(key)
+            if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+                return entry[0]
+            self._buckets[i][key] = (status, self._expiry(status))
+            return status
+
+    def __setitem__(self, key, status):
+        i = self._stripe(key)
+        now = time.monotonic()
+        with self._locks[i]:
+            bucket = self._buckets[i]
+            # Sweep expired entries from this stripe while we hold its lock
+            for k in [k for k, (_, exp) in bucket.items() if exp is not None and exp <= now]:
+                del bucket[k]
+            bucket[key] = (status, self._expiry(status))
+
 # In-memory processing status tracker
-processing_status = {}
+processing_status = StatusStore()
+
+# Uploads are orchestrated on a few threads; all OCR/CV work runs in one shared
+# page pool. The bounded queue caps running + waiting uploads.
+MAX_UPLOAD_JOBS = 2
+MAX_PAGE_WORKERS = os.cpu_count() or 1
+MAX_PENDING_JOBS = 4 * MAX_PAGE_WORKERS
+executor = ThreadPoolExecutor(max_workers=MAX_UPLOAD_JOBS)
+pending_jobs = queue.Queue(maxsize=MAX_PENDING_JOBS)
+
+_page_pool = None
+_page_pool_lock = threading.Lock()
+
+def _init_page_worker():
+    # Pages are already spread over processes; keep OpenCV from adding a thread per core
+    cv2.setNumThreads(1)
+
+def get_page_pool():
+    """Shared page pool, started on first use and kept for the life of the server"""
+    global _page_pool
+    with _page_pool_lock:
+        if _page_pool is None:
+            # spawn: the server is multithreaded, which makes fork() unsafe
+            _page_pool = ProcessPoolExecutor(max_workers=MAX_PAGE_WORKERS,
+                                             mp_context=multiprocessing.get_context('spawn'),
+                                             initializer=_init_page_worker)
+        return _page_pool
+
+def reset_page_pool(broken):
+    """Discard a pool whose worker died so the next job starts a fresh one"""
+    global _page_pool
+    with _page_pool_lock:
+        if _page_pool is broken:
+            _page_pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+# Uppercase alphanumeric token (2-6 chars, at least one letter), optionally wrapped in punctuation
+_SYMBOL_RE = re.compile(r'(?<!\S)[.,;:()]*((?=[0-9]*[A-Z])[A-Z0-9]{2,6})[.,;:()]*(?!\S)')
+
+# Common OCR mistakes in fixture symbols
+_CLEAN_MAP = {
+    'AIE': 'A1E', 'AlE': 'A1E', 'AE': 'A1E', 'A1': 'A1',
+    'BLOG': 'A1E', 'JOT': 'A1E', 'TA': 'A1E', 'T': 'W',
+    'I': 'W', 'O': '0', 'S': '5'
+}
+
+# Descriptions used when the rulebook has no entry for a symbol
+_FALLBACK = {
+    "A1": "2x4 LED Emergency Fixture",
+    "A1E": "Exit/Emergency Combo Unit",
+    "W": "Wall-Mounted Emergency LED",
+    "P": "Parking Lot Light",
+    "EL": "Emergency Light",
+    "EX": "Exit Sign"
+}
 
 @app.route('/')
 def home():
-    return jsonify({
+    return json_response({
         "status": "alive",
         "service": "Emergency Lighting Detection API",
         "endpoints": [
@@ -30,26 +149,39 @@ def home():
 @app.route('/blueprints/upload', methods=['POST'])
 def upload():
     if 'file' not in request.files:
-        return jsonify({"error": "No file uploaded"}), 400
+        return json_response({"error": "No file uploaded"}), 400
 
     file = request.files['file']
     if file.filename == '':
-        return jsonify({"error": "No file selected"}), 400
+        return json_response({"error": "No file selected"}), 400
 
     pdf_name = file.filename
     project_id = request.form.get('project_id', 'default')
 
-    file_path = os.path.join(UPLOAD_FOLDER, pdf_name)
-    file.save(file_path)
+    # Reserve a slot before touching the disk so overload is rejected cheaply
+    try:
+        pending_jobs.put_nowait(pdf_name)
+    except queue.Full:
+        return json_response({"error": "Too many uploads in progress, please try again later"}), 503
 
-    # Start background processing
-    if pdf_name not in processing_status:
-        processing_status[pdf_name] = {"status": "in_progress"}
+    try:
+        # Stream the upload straight to disk in 1 MiB chunks
+        file_path = os.path.join(UPLOAD_FOLDER, pdf_name)
+        with open(file_path, 'wb', buffering=1 << 20) as out:
+            shutil.copyfileobj(file.stream, out, length=1 << 20)
 
-    thread = threading.Thread(target=background_process, args=(file_path, pdf_name))
-    thread.start()
+        future = executor.submit(background_process, file_path, pdf_name)
+    except Exception as e:
+        # Give the slot back if the job never made it to the pool
+        pending_jobs.get_nowait()
+        print(f"❌ ERROR: {e}")
+        return json_response({"error": "Could not start processing", "details": str(e)}), 500
 
-    return jsonify({
+    # Start background processing
+    processing_status.setdefault(pdf_name, {"status": "in_progress"})
+    future.add_done_callback(partial(on_process_done, pdf_name))
+
+    return json_response({
         "status": "uploaded",
         "pdf_name": pdf_name,
         "message": "Processing started in background."
@@ -59,137 +191,177 @@ def upload():
 def get_result():
     pdf_name = request.args.get('pdf_name')
     if not pdf_name:
-        return jsonify({"error": "pdf_name is required"}), 400
+        return json_response({"error": "pdf_name is required"}), 400
 
-    if pdf_name not in processing_status:
-        return jsonify({"error": "PDF not found or not processed"}), 404
+    status_info = processing_status.get(pdf_name)
+    if status_info is None:
+        return json_response({"error": "PDF not found or not processed"}), 404
 
-    status_info = processing_status[pdf_name]
     if status_info["status"] == "in_progress":
-        return jsonify({
+        return json_response({
             "pdf_name": pdf_name,
             "status": "in_progress",
             "message": "Processing is still in progress. Please try again later."
         })
 
     if status_info["status"] == "complete":
-        return jsonify({
+        return json_response({
             "pdf_name": pdf_name,
             "status": "complete",
             "result": status_info["result"]
         })
 
-    return jsonify({
+    return json_response({
         "error": "Processing failed",
         "details": status_info.get("message", "Unknown error")
     }), 500
 
+def build_symbol_matcher(symbols):
+    """Aho-Corasick automaton over the known fixture symbols"""
+    automaton = ahocorasick.Automaton()
+    for sym in symbols:
+        automaton.add_word(sym, sym)
+    automaton.make_automaton()
+    return automaton
+
+def match_known_symbol(matcher, text):
+    """First multi-character known symbol standing alone as a token in text, or None.
+
+    One-letter symbols (W, P, ...) only match when they are the whole text, so a
+    stray letter cannot win over a real symbol further along.
+    """
+    for end, sym in matcher.iter(text):
+        if len(sym) < 2:
+            continue
+        start = end - len(sym) + 1
+        if (start == 0 or not text[start - 1].isalnum()) and \
+                (end + 1 == len(text) or not text[end + 1].isalnum()):
+            return sym
+
+    sym = text.strip().strip('.,;:()')
+    if len(sym) == 1 and sym in matcher:
+        return sym
+    return None
+
+def process_page(image, name, matcher=None):
+    """Detect emergency lights on a single page (runs in the page pool).
+
+    Returns (name, bboxes, symbols, texts) with bboxes as an (N, 4) int32 array.
+    """
+    detections = detect_shaded_rectangles(image)
+    bboxes = np.array([det["bounding_box"] for det in detections], dtype=np.int32).reshape(-1, 4)
+    symbols, texts = [], []
+    if not detections:
+        return name, bboxes, symbols, texts
+
+    # One OCR pass per page; nearby text is looked up from the word boxes
+    words = extract_page_words(image)
+    for det in detections:
+        nearby_text = extract_nearby_text(words, det["bounding_box"])
+
+        # Extract symbol from nearby text: known symbols first, then the generic heuristic
+        symbol = match_known_symbol(matcher, nearby_text) if matcher is not None else None
+        if symbol is None:
+            match = _SYMBOL_RE.search(nearby_text)
+            symbol = match.group(1) if match else "UNKNOWN"
+        symbols.append(symbol)
+        texts.append(nearby_text)
+    return name, bboxes, symbols, texts
+
+def on_process_done(pdf_name, future):
+    """Release the job slot and record the job's final status"""
+    pending_jobs.get_nowait()
+    try:
+        processing_status[pdf_name] = future.result()
+    except Exception as e:
+        print(f"❌ ERROR: {e}")
+        processing_status[pdf_name] = {
+            "status": "error",
+            "message": str(e)
+        }
+
 def background_process(file_path, pdf_name):
+    """Run the full pipeline for one upload and return the final status"""
+    pool = get_page_pool()
     try:
         print(f"🚀 Starting processing for {pdf_name}")
 
         # Step 1: Extract rulebook (General Notes + Lighting Schedule Table)
-        rulebook = extract_notes_and_table(file_path)
+        rulebook = pool.submit(extract_notes_and_table, file_path).result()
         rulebook_file = os.path.join(RESULTS_FOLDER, f"rulebook_{pdf_name}.json")
-        with open(rulebook_file, 'w') as f:
-            json.dump({"rulebook": rulebook}, f, indent=2)
+        write_json(rulebook_file, {"rulebook": rulebook})
         print(f"✅ Rulebook saved: {len(rulebook)} items")
 
-        # Step 2: Convert PDF to images and detect emergency lights
-        images = pdf_to_images(file_path)
-        all_detections = []
-
-        for img_data in images:
-            detections = detect_shaded_rectangles(img_data["image"])
-            for det in detections:
-                bbox = det["bounding_box"]
-                nearby_text = extract_nearby_text(img_data["image"], bbox)
-
-                # Extract symbol from nearby text
-                symbol = "UNKNOWN"
-                for word in nearby_text.split():
-                    word = word.strip('.,;:()')
-                    if word.isalnum() and word.isupper() and 2 <= len(word) <= 6:
-                        symbol = word
-                        break
-
-                all_detections.append({
-                    "symbol": symbol,
-                    "bounding_box": bbox,
-                    "text_nearby": nearby_text,
-                    "source_sheet": img_data["name"]
-                })
+        # Symbol -> description from the rulebook, first table row wins
+        symbol_desc = {}
+        for item in rulebook:
+            if item["type"] == "table_row":
+                symbol_desc.setdefault(item["symbol"].strip(), item["description"])
+        matcher = build_symbol_matcher(symbol_desc.keys() | _FALLBACK.keys())
+
+        # Step 2: Stream PDF pages and detect emergency lights
+        all_detections = DetectionTable()
+        first_page_name = None
+        page_futures = []
+        pending = set()
+        for img_data in pdf_to_images(file_path, grayscale=True):
+            if first_page_name is None:
+                first_page_name = img_data["name"]
+            future = pool.submit(process_page, img_data["image"], img_data["name"], matcher)
+            page_futures.append(future)
+            pending.add(future)
+            del img_data
+
+            # Keep at most one queued page per worker in memory
+            if len(pending) >= MAX_PAGE_WORKERS:
+                _, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+        # Collect in page order so the detections file is stable between runs
+        for future in page_futures:
+            all_detections.extend(*future.result())
 
         # Save raw detections
         det_file = os.path.join(RESULTS_FOLDER, f"detections_{pdf_name}.json")
-        with open(det_file, 'w') as f:
-            json.dump(all_detections, f, indent=2)
+        write_json(det_file, all_detections.to_dicts())
         print(f"✅ Found {len(all_detections)} detections")
 
         # Generate annotation screenshot
-        if images and all_detections:
-            draw_detections(images[0]["image"], all_detections[:10], "annotation_example.png")
-            print("🖼️ Annotation screenshot saved: annotation_example.png")
+        first_page = all_detections.to_dicts(sheet=first_page_name, limit=10)
+        if first_page:
+            page_one = next(pdf_to_images(file_path, first_page_only=True))
+            if draw_detections(page_one["image"], first_page, "annotation_example.png"):
+                print("🖼️ Annotation screenshot saved: annotation_example.png")
+            else:
+                print("⚠️ Failed to encode annotation screenshot")
 
         # Step 3: Group lights using rulebook + fallback logic
-        summary = {}
-        fallback = {
-            "A1": "2x4 LED Emergency Fixture",
-            "A1E": "Exit/Emergency Combo Unit",
-            "W": "Wall-Mounted Emergency LED",
-            "P": "Parking Lot Light",
-            "EL": "Emergency Light",
-            "EX": "Exit Sign"
-        }
-
-        for det in all_detections:
-            sym = det["symbol"]
-
-            # Clean up common OCR mistakes
-            clean_map = {
-                'AIE': 'A1E', 'AlE': 'A1E', 'AE': 'A1E', 'A1': 'A1',
-                'BLOG': 'A1E', 'JOT': 'A1E', 'TA': 'A1E', 'T': 'W',
-                'I': 'W', 'O': '0', 'S': '5'
+        # Count cleaned symbols, then resolve each distinct symbol's description once:
+        # Priority 1 is the rulebook, Priority 2 the fallback table
+        counts = Counter(_CLEAN_MAP.get(sym, sym) for sym in all_detections.symbols)
+        final_result = {
+            sym: {
+                "count": n,
+                "description": symbol_desc.get(sym) or _FALLBACK.get(sym, "Generic Emergency Light")
             }
-            sym = clean_map.get(sym, sym)
-
-            # Priority 1: Rulebook
-            desc = None
-            for item in rulebook:
-                if item["type"] == "table_row" and item["symbol"].strip() == sym:
-                    desc = item["description"]
-                    break
-
-            # Priority 2: Fallback
-            if not desc:
-                desc = fallback.get(sym, "Generic Emergency Light")
-
-            key = f"Light_{sym}"
-            if key not in summary:
-                summary[key] = {"count": 0, "description": desc}
-            summary[key]["count"] += 1
-
-        # Final result
-        final_result = {}
-        for k, v in summary.items():
-            tag = k.replace("Light_", "")
-            final_result[tag] = {"count": v["count"], "description": v["description"]}
+            for sym, n in counts.items()
+        }
 
         # Save result
         result_file = os.path.join(RESULTS_FOLDER, f"result_{pdf_name}.json")
-        with open(result_file, 'w') as f:
-            json.dump(final_result, f, indent=2)
+        write_json(result_file, final_result)
 
-        # Update status
-        processing_status[pdf_name] = {
+        print("🎉 Processing complete!")
+        return {
             "status": "complete",
             "result": final_result
         }
-        print("🎉 Processing complete!")
 
     except Exception as e:
+        if isinstance(e, BrokenProcessPool):
+            # A page worker died (e.g. killed for running out of memory)
+            reset_page_pool(pool)
         print(f"❌ ERROR: {e}")
-        processing_status[pdf_name] = {
+        return {
             "status": "error",
             "message": str(e)
         }
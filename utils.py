@@ -2,93 +2,143 @@
 import fitz  # PyMuPDF
 import cv2
 import numpy as np
-import pytesseract
+from tesserocr import PyTessBaseAPI, PSM, RIL, iterate_level
 import os
 import json
+import orjson
 import re
+import threading
 
-# Set Tesseract path (Windows only)
-try:
-    pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
-except Exception:
-    pass
+# Set tessdata path (Windows only); elsewhere libtesseract's default is used
+TESSDATA_PATH = r'C:\Program Files\Tesseract-OCR\tessdata' if os.name == 'nt' else None
 
-def pdf_to_images(pdf_path, dpi=200):
-    """Convert PDF to list of OpenCV images."""
+_tess = threading.local()
+
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+
+_WS_RE = re.compile(r'\s+')
+_TOK_RE = re.compile(r'\S+')
+# Table symbol: up to 6 uppercase letters/digits with at least one letter
+_SYM_RE = re.compile(r'(?=[0-9]*[A-Z])[A-Z0-9]{1,6}')
+
+# Letters OCR commonly reads in place of digits in rulebook symbols
+_SYMBOL_DIGITS = str.maketrans('OlI', '011')
+
+def render_page(page, dpi=200, clip=None, grayscale=False):
+    """Render a single PDF page (or the clip area of it) to an RGB or grayscale image array."""
+    zoom = dpi / 72
+    mat = fitz.Matrix(zoom, zoom)
+    if grayscale:
+        pix = page.get_pixmap(matrix=mat, colorspace=fitz.csGRAY, clip=clip)
+        return np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width)
+    pix = page.get_pixmap(matrix=mat, colorspace=fitz.csRGB, clip=clip)
+    img_data = np.frombuffer(pix.samples, dtype=np.uint8)
+    return img_data.reshape(pix.height, pix.width, 3)
+
+def pdf_to_images(pdf_path, dpi=200, first_page_only=False, grayscale=False):
+    """Yield page images one by one so only one page is held in memory."""
     doc = fitz.open(pdf_path)
-    images = []
-    for page_num in range(len(doc)):
-        page = doc.load_page(page_num)
-        zoom = dpi / 72
-        mat = fitz.Matrix(zoom, zoom)
-        pix = page.get_pixmap(matrix=mat)
-        img_data = np.frombuffer(pix.samples, dtype=np.uint8)
-        img = img_data.reshape(pix.height, pix.width, 3)
-        img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-        images.append({
-            "image": img,
-            "page_num": page_num + 1,
-            "name": os.path.basename(pdf_path).replace(".pdf", "") + f"_page_{page_num+1}"
-        })
-    doc.close()
-    return images
+    try:
+        page_count = min(len(doc), 1) if first_page_only else len(doc)
+        for page_num in range(page_count):
+            page = doc.load_page(page_num)
+            yield {
+                "image": render_page(page, dpi, grayscale=grayscale),
+                "page_num": page_num + 1,
+                "name": os.path.basename(pdf_path).replace(".pdf", "") + f"_page_{page_num+1}"
+            }
+    finally:
+        doc.close()
 
 def detect_shaded_rectangles(image, min_area=500, max_area=5000):
-    """Detect shaded rectangles (emergency lights)"""
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    """Detect shaded rectangles (emergency lights) on a grayscale or RGB page"""
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
     _, thresh = cv2.threshold(gray, 60, 255, cv2.THRESH_BINARY_INV)
     kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
     thresh = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel)
     contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
     detections = []
-    for cnt in contours:
-        area = cv2.contourArea(cnt)
+    if not contours:
+        return detections
+
+    # Filter on bounding boxes in NumPy first; contour area never exceeds w*h,
+    # so only the survivors need an exact cv2.contourArea check
+    rects = np.array([cv2.boundingRect(c) for c in contours], dtype=np.int32)
+    w, h = rects[:, 2], rects[:, 3]
+    aspect = w / np.maximum(h, 1)
+    keep = np.flatnonzero((w * h > min_area) & (aspect > 1.5) & (aspect < 4.0))
+
+    for i in keep:
+        area = cv2.contourArea(contours[i])
         if min_area < area < max_area:
-            x, y, w, h = cv2.boundingRect(cnt)
-            aspect_ratio = w / h
-            if 1.5 < aspect_ratio < 4.0:
-                detections.append({
-                    "bounding_box": [x, y, x+w, y+h],
-                    "area": area,
-                    "aspect_ratio": round(aspect_ratio, 2)
-                })
+            x, y, bw, bh = (int(v) for v in rects[i])
+            detections.append({
+                "bounding_box": [x, y, x+bw, y+bh],
+                "area": area,
+                "aspect_ratio": round(float(aspect[i]), 2)
+            })
     return detections
 
-def extract_nearby_text(image, bbox, padding=50):
-    """Extract text near bounding box"""
+def tesseract_api(gray, psm):
+    """Per-thread Tesseract engine loaded once, with gray set as the current image"""
+    api = getattr(_tess, "api", None)
+    # Engines are not carried across fork(); each worker process loads its own
+    if api is None or _tess.pid != os.getpid():
+        api = _tess.api = PyTessBaseAPI(path=TESSDATA_PATH) if TESSDATA_PATH else PyTessBaseAPI()
+        _tess.pid = os.getpid()
+    # Keep the bytes referenced until the next image replaces them
+    _tess.image = np.ascontiguousarray(gray).tobytes()
+    api.SetPageSegMode(psm)
+    api.SetImageBytes(_tess.image, gray.shape[1], gray.shape[0], 1, gray.shape[1])
+    return api
+
+def ocr_text(gray, psm=PSM.SINGLE_BLOCK):
+    """OCR a grayscale region into plain text"""
+    return tesseract_api(gray, psm).GetUTF8Text().strip()
+
+def extract_page_words(image):
+    """OCR the whole page once and return word centers as (text, cx, cy)"""
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    api = tesseract_api(gray, PSM.SPARSE_TEXT)
+    api.Recognize()
+    words = []
+    for word in iterate_level(api.GetIterator(), RIL.WORD):
+        text = (word.GetUTF8Text(RIL.WORD) or "").strip()
+        if text:
+            x1, y1, x2, y2 = word.BoundingBox(RIL.WORD)
+            words.append((text, (x1 + x2) // 2, (y1 + y2) // 2))
+    return words
+
+def extract_nearby_text(words, bbox, padding=50):
+    """Extract text near bounding box from the page's OCR words"""
     x1, y1, x2, y2 = bbox
     cx, cy = (x1 + x2) // 2, (y1 + y2) // 2
-    h, w = image.shape[:2]
-    roi_x1 = max(0, cx - padding)
-    roi_y1 = max(0, cy - padding)
-    roi_x2 = min(w, cx + padding)
-    roi_y2 = min(h, cy + padding)
-    roi = image[roi_y1:roi_y2, roi_x1:roi_x2]
-    gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
-    return pytesseract.image_to_string(gray, config='--psm 6').strip()
-
-def extract_notes_and_table(pdf_path):
+    return " ".join(text for text, wx, wy in words
+                    if abs(wx - cx) <= padding and abs(wy - cy) <= padding)
+
+def extract_notes_and_table(pdf_path, dpi=200):
     """Extract General Notes and Lighting Schedule Table using OCR on image regions"""
     doc = fitz.open(pdf_path)
     rulebook = []
+    zoom = dpi / 72
+    mat = fitz.Matrix(zoom, zoom)
+    to_page = ~mat  # pixel coordinates at dpi -> page coordinates
 
     for page_num in range(len(doc)):
         sheet_name = f"{os.path.basename(pdf_path)}_page_{page_num+1}"
         page = doc.load_page(page_num)
-        pix = page.get_pixmap(dpi=200)
-        img_data = np.frombuffer(pix.samples, dtype=np.uint8)
-        image = img_data.reshape(pix.height, pix.width, 3)
-        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
 
-        h, w = image.shape[:2]
+        # Only the two regions are rendered, never the full page
+        full = (page.rect * mat).irect
+        h, w = full.height, full.width
 
         # --- Region 1: Top-Left (General Notes)
-        roi_notes = image[50:400, 50:700]
-        notes_text = pytesseract.image_to_string(roi_notes, config='--psm 6').strip()
+        roi_notes = render_page(page, dpi, clip=fitz.Rect(50, 50, 700, 400) * to_page, grayscale=True)
+        notes_text = ocr_text(roi_notes)
         if len(notes_text) > 10:
             for line in notes_text.split('\n'):
-                line = re.sub(r'\s+', ' ', line.strip())
+                line = _WS_RE.sub(' ', line).strip()
                 if len(line) > 5 and any(kw in line.lower() for kw in ["emergency", "unswitched", "power", "note"]):
                     rulebook.append({
                         "type": "note",
@@ -97,21 +147,19 @@ def extract_notes_and_table(pdf_path):
                     })
 
         # --- Region 2: Bottom-Right (Lighting Schedule Table)
-        roi_table = image[h-600:h-100, w-800:w-100]
-        table_text = pytesseract.image_to_string(roi_table, config='--psm 6').strip()
+        roi_table = render_page(page, dpi, clip=fitz.Rect(w-800, h-600, w-100, h-100) * to_page,
+                                grayscale=True)
+        table_text = ocr_text(roi_table)
 
         if len(table_text) > 20:
             lines = table_text.split('\n')
             for line in lines:
-                line = re.sub(r'\s+', ' ', line.strip())
-                if not line:
-                    continue
-                parts = line.split()
+                parts = _TOK_RE.findall(line)
                 if len(parts) < 3:
                     continue
 
                 symbol = parts[0]
-                if len(symbol) <= 6 and symbol.isalnum() and symbol.isupper():
+                if _SYM_RE.fullmatch(symbol):
                     description = " ".join(parts[1:5])
                     rulebook.append({
                         "type": "table_row",
@@ -129,7 +177,7 @@ def group_lights(detections, rulebook):
     for item in rulebook:
         if item["type"] == "table_row":
             symbol = item["symbol"].strip()
-            symbol = symbol.replace('O', '0').replace('l', '1').replace('I', '1')
+            symbol = symbol.translate(_SYMBOL_DIGITS)
             if len(symbol) <= 5 and symbol.isalnum():
                 symbol_desc[symbol] = item["description"]
 
@@ -139,15 +187,15 @@ def group_lights(detections, rulebook):
         "W": "Wall-Mounted Emergency LED"
     }
 
+    # Clean up OCR garbage
+    clean_map = {
+        'AIE': 'A1E', 'AlE': 'A1E', 'AE': 'A1E', 'A1': 'A1',
+        'BLOG': 'A1E', 'JOT': 'A1E', 'TA': 'A1E', 'T': 'W'
+    }
+
     summary = {}
     for det in detections:
         sym = det["symbol"]
-
-        # Clean up OCR garbage
-        clean_map = {
-            'AIE': 'A1E', 'AlE': 'A1E', 'AE': 'A1E', 'A1': 'A1',
-            'BLOG': 'A1E', 'JOT': 'A1E', 'TA': 'A1E', 'T': 'W'
-        }
         sym = clean_map.get(sym, sym)
 
         desc = symbol_desc.get(sym, fallback.get(sym, "Generic Emergency Light"))
@@ -159,12 +207,66 @@ def group_lights(detections, rulebook):
 
     return {"summary": summary}
 
+class DetectionTable:
+    """Detections stored column-wise: an int32 bbox array plus parallel symbol/text/sheet lists"""
+
+    BLOCK = 1024
+
+    def __init__(self):
+        self.bboxes = np.zeros((self.BLOCK, 4), dtype=np.int32)
+        self.symbols = []
+        self.texts = []
+        self.sheets = []
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def extend(self, sheet, bboxes, symbols, texts):
+        start, n = len(self), len(symbols)
+        if start + n > len(self.bboxes):
+            # Grow geometrically, rounded up to whole blocks
+            size = max(2 * len(self.bboxes), start + n)
+            grown = np.zeros((-(-size // self.BLOCK) * self.BLOCK, 4), dtype=np.int32)
+            grown[:start] = self.bboxes[:start]
+            self.bboxes = grown
+        self.bboxes[start:start + n] = bboxes
+        self.symbols.extend(symbols)
+        self.texts.extend(texts)
+        self.sheets.extend([sheet] * n)
+
+    def to_dicts(self, sheet=None, limit=None):
+        """Convert back to the detection dict schema (for JSON output and drawing)"""
+        rows = []
+        for i, bbox in enumerate(self.bboxes[:len(self)].tolist()):
+            if sheet is not None and self.sheets[i] != sheet:
+                continue
+            rows.append({
+                "symbol": self.symbols[i],
+                "bounding_box": bbox,
+                "text_nearby": self.texts[i],
+                "source_sheet": self.sheets[i]
+            })
+            if limit is not None and len(rows) >= limit:
+                break
+        return rows
+
+def write_json(path, obj):
+    """Write obj as indented JSON with a single buffered binary write"""
+    with open(path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+        f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+
 def draw_detections(image, detections, output_path):
     """Draw bounding boxes and labels"""
-    img_copy = image.copy()
+    # Pages are RGB; convert once so the PNG encoder gets BGR
+    img_copy = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
     for det in detections:
         x1, y1, x2, y2 = det["bounding_box"]
         cv2.rectangle(img_copy, (x1, y1), (x2, y2), (0, 255, 0), 2)
         cv2.putText(img_copy, det["symbol"], (x1, y1 - 10),
                     cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
-    cv2.imwrite(output_path, img_copy)
+    # Fast PNG compression, then one write of the encoded bytes
+    ok, buf = cv2.imencode('.png', img_copy, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    if ok:
+        with open(output_path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+            f.write(buf)
+    return ok